@@ -1,2 +1,2 @@
 """Version definition to track changes"""
-__version__ = "0.3.6"
+__version__ = "0.4.0"
@@ -1,109 +1,640 @@
-from pathlib import PurePath, Path
-from zipfile import ZipFile, is_zipfile, BadZipFile
-from zlib import decompressobj, MAX_WBITS, error as ZLIB_error
+import asyncio
+import mmap
+import os
+import re
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
+from zipfile import ZipFile, BadZipFile, ZIP_STORED, ZIP_DEFLATED
+from zlib import decompressobj, crc32, MAX_WBITS, error as ZLIB_error
+
+_AVAILABLE_BACKENDS = {
+    'zlib': {'factory': decompressobj, 'crc32': crc32, 'error': ZLIB_error},
+}
 
-missed_modules = 0
-async_reader = 'aiofile'
 try:
-    from aiofile import async_open
+    from zlib_ng import zlib_ng
+    _AVAILABLE_BACKENDS['zlib-ng'] = {
+        'factory': zlib_ng.decompressobj, 'crc32': zlib_ng.crc32, 'error': zlib_ng.error}
 except ModuleNotFoundError as err:
-    missed_modules += 1
+    pass
 
 try:
-    from aiofiles import open as async_open
-    async_reader = 'aiofiles'
+    from isal import isal_zlib
+    _AVAILABLE_BACKENDS['python-isal'] = {
+        'factory': isal_zlib.decompressobj, 'crc32': isal_zlib.crc32, 'error': isal_zlib.error}
 except ModuleNotFoundError as err:
-    missed_modules += 1
-except ImportError as err:
-    missed_modules += 1
+    pass
 
-if missed_modules == 2:
-    print("""Not aiofile nor aiofiles is present! Going to crash..
-        please do:
-            pip install aiofile
-        or
-            pip install aiofiles
-        to make the code working, Thanks!""")
+# igzip (python-isal) inflates faster than zlib-ng, which is faster than stock zlib
+BACKEND_PREFERENCE = ('python-isal', 'zlib-ng', 'zlib')
+
+try:
+    # libdeflate bindings, one-shot raw DEFLATE into a buffer of the known size
+    import deflate
+except ModuleNotFoundError as err:
+    deflate = None
+
+try:
+    import fcntl
+except ModuleNotFoundError as err:
+    fcntl = None
+
+try:
+    import uvloop
+except ModuleNotFoundError as err:
+    uvloop = None
 
 
 DEFAULT_READ_BUFFER_SIZE = 64 * 1024
+# python-isal and zlib-ng amortise their per-call setup better on bigger input blocks
+LARGE_READ_BUFFER_SIZE = 256 * 1024
+# entries up to this uncompressed size are inflated with a single call
+SMALL_ENTRY_LIMIT = 4 * 1024 * 1024
+# entries smaller than this are extracted in batches of SMALL_ENTRY_BATCH per worker job,
+# for them the scheduling overhead costs more than the extraction itself
+SMALL_ENTRY_BATCH_LIMIT = 64 * 1024
+SMALL_ENTRY_BATCH = 64
+# smaller outputs are written with a single write(), preallocating them is one syscall for nothing
+PREALLOCATE_MIN_SIZE = 64 * 1024
+# streamed entries are written once this many inflated bytes are pending
+WRITE_HIGH_WATER = 1024 * 1024
+# the most buffers a single writev() accepts
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+# madvise() is not available everywhere (python < 3.8, windows)
+MADV_SEQUENTIAL = getattr(mmap, 'MADV_SEQUENTIAL', None)
+MADV_WILLNEED = getattr(mmap, 'MADV_WILLNEED', None)
+MADV_DONTNEED = getattr(mmap, 'MADV_DONTNEED', None)
+# read-ahead asked for at once, a big entry is read ahead by the kernel as it is consumed
+WILLNEED_LIMIT = 8 * 1024 * 1024
+# inflate is CPU-bound and releases the GIL, more threads than cores do not help
+DEFAULT_MAX_WORKERS = os.cpu_count() or 1
+LOCAL_FILE_HEADER_SIZE = 30
+LOCAL_FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+# signature, file name and extra field lengths, the fields in between are taken from the central directory
+_LOCAL_FILE_HEADER = struct.Struct('<4s22xHH')
 
 
-async def unzip(zip_file, path=None, files=[], regex_files=None, buffer_size=None, __debug=None):
-    read_block = buffer_size if (buffer_size and int(buffer_size)>0) else DEFAULT_READ_BUFFER_SIZE
+# macOS has no posix_fallocate(), fcntl(F_PREALLOCATE) takes an fstore_t:
+# fst_flags, fst_posmode, fst_offset, fst_length, fst_bytesalloc
+F_PREALLOCATE = getattr(fcntl, 'F_PREALLOCATE', 42)
+F_ALLOCATEALL = getattr(fcntl, 'F_ALLOCATEALL', 4)
+F_PEOFPOSMODE = getattr(fcntl, 'F_PEOFPOSMODE', 3)
+_FSTORE = struct.Struct('Iiqqq')
 
-    if is_zipfile(zip_file):
-        files_info = ZipFile(zip_file).infolist()
-        if path == None:
-            extra_path = ''
-        else:
-            extra_path = PurePath(path)
-        async with async_open(zip_file, mode='rb') as src:
-            for in_file in files_info:
-                file_name = in_file.filename
-                unpack_filename_path = Path(str(PurePath(extra_path, file_name)))
-                if __debug:
-                    print(in_file)
-                    print(unpack_filename_path)
-                if async_reader == 'aiofile':
-                    src.seek(in_file.header_offset)
-                else:
-                    await src.seek(in_file.header_offset)
-                if __debug:
-                    print(f'Done HEADER_OFFSET seek: {in_file.header_offset}')
-                temp = await src.read(30)
-                if __debug:
-                    print(f'Done FILEPATH seek: {30} - {temp}')
-                temp = await src.read(len(in_file.filename))
-                if __debug:
-                    print(f'Done FILENAME seek: {len(in_file.filename)} - {temp}')
-                if in_file.file_size < 4294967296:
-                    if len(in_file.extra) > 0:
-                        t = await src.read(len(in_file.extra))
-                        if __debug:
-                            print(f'Done EXTRA seek: {len(in_file.extra)} {t}')
-                    if len(in_file.comment) > 0:
-                        await src.read(len(in_file.comment))
-                        if __debug:
-                            print(f'Done COMMENT seek: {len(in_file.comment)}')
-
-                if in_file.is_dir():
-                    unpack_filename_path.mkdir(parents=True, exist_ok=True)
-                    continue
-                else:
-                    unpack_filename_path.parent.mkdir(parents=True, exist_ok=True)
-
-                async with async_open(str(unpack_filename_path), 'wb+') as out:
-                    i = in_file.compress_size
-                    buf = await src.read(read_block)
-
-                    decomp_window_bits = None
-                    for window_bits in (-MAX_WBITS, MAX_WBITS | 16, MAX_WBITS):
-                        try:
-                            decomp_window_bits = window_bits
-                            if __debug:
-                                print(f"Try WindowBits: {window_bits}")
-                            decompressobj(window_bits).decompress(buf)
-                            break
-                        except ZLIB_error:
-                            if __debug:
-                                print(f"Failed WindowBits: {window_bits}")
-
-                    decomp = decompressobj(decomp_window_bits)
-                    if __debug:
-                        print(f'Incoming Length: {len(buf)}')
-                    while buf:
-                        result = decomp.decompress(buf)
-                        await out.write(result)
-                        curr_read_block = read_block if i > read_block else i
-                        buf = await src.read(curr_read_block)
-                        i -= curr_read_block
-                        if __debug:
-                            print(f'Length: {len(buf)}')
-
-                    result = decomp.flush()
+
+O_BINARY = getattr(os, 'O_BINARY', 0)
+OUTPUT_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _write_chunks(fd, chunks):
+    """Writes the chunks in order, with as few writev() calls as possible"""
+    if not hasattr(os, 'writev'):
+        for chunk in chunks:
+            _write_all(fd, chunk)
+        return
+    views = [memoryview(chunk) for chunk in chunks if chunk]
+    first = 0
+    while first < len(views):
+        written = os.writev(fd, views[first:first + IOV_MAX])
+        # a short write may stop anywhere, fully written views are skipped, a partial one is trimmed
+        while first < len(views) and written >= len(views[first]):
+            written -= len(views[first])
+            first += 1
+        if written:
+            views[first] = views[first][written:]
+
+
+def _preallocate(fd, size):
+    """Reserves size bytes for an empty output file, returns False when it is not supported.
+    posix_fallocate() also sets the file size, fcntl(F_PREALLOCATE) does not"""
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(fd, 0, size)
+        return True
+    if sys.platform == 'darwin' and fcntl is not None:
+        fcntl.fcntl(fd, F_PREALLOCATE, _FSTORE.pack(F_ALLOCATEALL, F_PEOFPOSMODE, 0, size, 0))
+        return True
+    return False
+
+
+def _default_backend():
+    """ASYNC_UNZIP_BACKEND environment variable wins, otherwise the fastest installed backend"""
+    name = os.environ.get('ASYNC_UNZIP_BACKEND')
+    if name:
+        return name
+    for name in BACKEND_PREFERENCE:
+        if name in _AVAILABLE_BACKENDS:
+            return name
+
+
+def _resolve_backend(name):
+    if name not in _AVAILABLE_BACKENDS:
+        raise ValueError(f"Decompression backend {name!r} is not available, "
+                         f"choose from: {', '.join(_AVAILABLE_BACKENDS)}")
+    backend = _AVAILABLE_BACKENDS[name]
+    return backend['factory'], backend['crc32'], backend['error']
+
+
+# numbered/named backreferences and group conditionals, in a union their group numbers would shift
+_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def _compile_patterns(regex_files):
+    """Returns a search function for the regex_files patterns. A list is folded into one alternation,
+    so every name is scanned once, unless that would change what a pattern means"""
+    if not regex_files:
+        return None
+    if isinstance(regex_files, str):
+        return re.compile(regex_files).search
+    patterns = [re.compile(pattern) for pattern in regex_files]
+    # inline global flags ("(?i)...") are only allowed at the very start, wrapped they fail or spread
+    foldable = all(
+        not pattern.flags & ~re.UNICODE and not (pattern.groups and _GROUP_REFERENCE.search(pattern.pattern))
+        for pattern in patterns)
+    if foldable:
+        try:
+            return re.compile("|".join(f"(?:{pattern.pattern})" for pattern in patterns)).search
+        except re.error:
+            # e.g. the same group name in two patterns
+            pass
+
+    def search(file_name):
+        return any(pattern.search(file_name) for pattern in patterns)
+    return search
+
+
+def _should_extract(file_name, whitelist, regex_search):
+    if whitelist is not None and file_name not in whitelist:
+        return False
+    return regex_search is None or bool(regex_search(file_name))
+
+
+def _select_buffer_size(buffer_size, fd, backend_name):
+    """An explicit buffer_size wins, otherwise at least the filesystem block size rounded up to whole pages"""
+    if buffer_size and int(buffer_size) > 0:
+        return int(buffer_size)
+    size = DEFAULT_READ_BUFFER_SIZE if backend_name == 'zlib' else LARGE_READ_BUFFER_SIZE
+    size = max(size, getattr(os.fstat(fd), 'st_blksize', 0))
+    return -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+
+
+def _advise(mm, advice, start, length):
+    """Best effort madvise() hint for a byte range of the archive map, an empty range is skipped"""
+    if advice is None or length <= 0:
+        return
+    aligned = start - start % mmap.PAGESIZE
+    try:
+        mm.madvise(advice, aligned, length + start - aligned)
+    except (OSError, ValueError):
+        pass
+
+
+def _check_size(in_file, size, eof=True):
+    # the declared size picks the extraction path and bounds the output, a lie is an error
+    if size != in_file.file_size or not eof:
+        raise BadZipFile(f"Bad uncompressed size for {in_file.filename}")
+
+
+def _check_crc(in_file, crc):
+    if crc != in_file.CRC:
+        raise BadZipFile(f"Bad CRC-32 for file {in_file.filename!r}")
+
+
+def _read_local_header(mm, in_file, __debug=None):
+    """Returns the offset of the entry data. Name and extra field lengths are taken from the
+    local header, they may differ from the central directory ones"""
+    if in_file.header_offset + LOCAL_FILE_HEADER_SIZE > len(mm):
+        raise BadZipFile(f"Bad local file header for {in_file.filename}")
+    # unpacked straight from the map, without copying the header out first
+    signature, name_length, extra_length = _LOCAL_FILE_HEADER.unpack_from(mm, in_file.header_offset)
+    if __debug:
+        print(f'Done LOCAL HEADER read at {in_file.header_offset}: {signature}, {name_length}, {extra_length}')
+    if signature != LOCAL_FILE_HEADER_SIGNATURE:
+        raise BadZipFile(f"Bad local file header for {in_file.filename}")
+    return in_file.header_offset + LOCAL_FILE_HEADER_SIZE + name_length + extra_length
+
+
+def _copy_file_range(fd, out_fd, offset, count):
+    return os.copy_file_range(fd, out_fd, count, offset)
+
+
+def _sendfile(fd, out_fd, offset, count):
+    return os.sendfile(out_fd, fd, offset, count)
+
+
+# tried in order, copy_file_range() may be refused (e.g. EXDEV across filesystems before
+# linux 5.3) where sendfile() still works. sendfile() only accepts a regular file as
+# destination on linux, on macOS/BSD it needs a socket
+_KERNEL_COPIES = []
+if hasattr(os, 'copy_file_range'):
+    _KERNEL_COPIES.append(_copy_file_range)
+if sys.platform.startswith('linux') and hasattr(os, 'sendfile'):
+    _KERNEL_COPIES.append(_sendfile)
+
+
+def _copy_in_kernel(fd, offset, out_fd, remaining, __debug=None):
+    """Copies up to remaining bytes without passing them through user space,
+    returns how many bytes were copied"""
+    copied = 0
+    for kernel_copy in _KERNEL_COPIES:
+        try:
+            while copied < remaining:
+                done = kernel_copy(fd, out_fd, offset + copied, remaining - copied)
+                if not done:
+                    break
+                copied += done
+            break
+        except OSError as err:
+            if __debug:
+                print(f'{kernel_copy.__name__} failed after {copied} bytes: {err}')
+    return copied
+
+
+def _write_stored_entry(mm, fd, offset, out_fd, in_file, read_block, crc32, __debug=None):
+    _check_size(in_file, in_file.compress_size)
+    if crc32 is not None:
+        # checked before copying, the stored data is the output itself. Window by window,
+        # each one is dropped after use, a big entry would otherwise become resident as a whole.
+        # Windows end on read_block multiples of the map: fault-around maps the aligned block
+        # around a fault, an unaligned window would map back the tail of the dropped one
+        end = offset + in_file.compress_size
+        crc = 0
+        start = offset
+        with memoryview(mm) as view:
+            while start < end:
+                stop = min((start // read_block + 1) * read_block, end)
+                with view[start:stop] as buf:
+                    crc = crc32(buf, crc)
+                _advise(mm, MADV_DONTNEED, start, stop - start)
+                start = stop
+        _check_crc(in_file, crc)
+    copied = _copy_in_kernel(fd, offset, out_fd, in_file.compress_size, __debug)
+    if copied < in_file.compress_size:
+        with memoryview(mm) as view, view[offset + copied:offset + in_file.compress_size] as buf:
+            _write_all(out_fd, buf)
+
+
+def _inflate_oneshot(buf, in_file, factory, error_types, __debug=None):
+    if deflate is not None:
+        try:
+            # fails when the output does not fit into file_size, a shorter one is checked by the caller
+            return deflate.deflate_decompress(buf, in_file.file_size)
+        except deflate.DeflateError:
+            if __debug:
+                print("libdeflate failed, falling back to the decompression backend")
+    try:
+        decomp = factory(-MAX_WBITS)
+        # one byte over the declared size is enough to tell it was a lie, the output stays bounded
+        result = decomp.decompress(buf, in_file.file_size + 1)
+    except error_types as err:
+        raise BadZipFile(f"Bad compressed data for {in_file.filename}") from err
+    _check_size(in_file, len(result), decomp.eof)
+    return result
+
+
+def _write_compressed_entry_oneshot(mm, offset, out_fd, in_file, factory, crc32, error_types, __debug=None):
+    with memoryview(mm) as view, view[offset:offset + in_file.compress_size] as buf:
+        result = _inflate_oneshot(buf, in_file, factory, error_types, __debug)
+    _check_size(in_file, len(result))
+    if crc32 is not None:
+        # the whole entry is in memory, one call lets the SIMD CRC run over all of it
+        _check_crc(in_file, crc32(result))
+    _write_all(out_fd, result)
+
+
+def _write_compressed_entry(mm, offset, out_fd, in_file, read_block, factory, crc32, error_types, __debug=None):
+    end = offset + in_file.compress_size
+    crc = 0
+    # inflated chunks are collected and written together with one writev()
+    pending = []
+    pending_size = 0
+    total_size = 0
+    consumed = offset
+    try:
+        # every slice is released by its with-block, an exported buffer would keep mm from closing
+        with memoryview(mm) as view:
+            # ZIP_DEFLATED entries are raw DEFLATE streams
+            decomp = factory(-MAX_WBITS)
+            while offset < end:
+                with view[offset:min(offset + read_block, end)] as buf:
                     if __debug:
-                        print(f'Flush Length: {len(buf)}')
-                    await out.write(result)
-    else:
-        raise BadZipFile
+                        print(f'Length: {len(buf)}')
+                    # the output of one call is capped, a highly compressed block could
+                    # otherwise inflate to hundreds of MiB at once
+                    result = decomp.decompress(buf, WRITE_HIGH_WATER)
+                offset += read_block
+                while True:
+                    total_size += len(result)
+                    if total_size > in_file.file_size:
+                        # nothing past the declared size is written
+                        _check_size(in_file, total_size)
+                    if crc32 is not None:
+                        crc = crc32(result, crc)
+                    pending.append(result)
+                    pending_size += len(result)
+                    if pending_size >= WRITE_HIGH_WATER:
+                        _write_chunks(out_fd, pending)
+                        pending = []
+                        pending_size = 0
+                        # the input read so far is not needed anymore, a big entry does not stay resident.
+                        # Draining unconsumed_tail may write more than once per block
+                        if min(offset, end) > consumed:
+                            _advise(mm, MADV_DONTNEED, consumed, min(offset, end) - consumed)
+                            consumed = min(offset, end)
+                    if not decomp.unconsumed_tail:
+                        break
+                    result = decomp.decompress(decomp.unconsumed_tail, WRITE_HIGH_WATER)
+
+        result = decomp.flush()
+    except error_types as err:
+        raise BadZipFile(f"Bad compressed data for {in_file.filename}") from err
+    if __debug:
+        print(f'Flush Length: {len(result)}')
+    _check_size(in_file, total_size + len(result), decomp.eof)
+    pending.append(result)
+    _write_chunks(out_fd, pending)
+    if crc32 is not None:
+        _check_crc(in_file, crc32(result, crc))
+
+
+def _extract_entry_sync(mm, fd, in_file, unpack_str, read_block,
+                       factory, crc32, error_types, __debug=None):
+    if __debug:
+        print(in_file)
+        print(unpack_str)
+    if in_file.file_size == 0:
+        # empty files need neither the local header nor a decompressor
+        os.close(os.open(unpack_str, OUTPUT_FLAGS, 0o666))
+        return
+
+    offset = _read_local_header(mm, in_file, __debug)
+    if offset + in_file.compress_size > len(mm):
+        raise BadZipFile(f"Truncated data for {in_file.filename}")
+
+    out_fd = os.open(unpack_str, OUTPUT_FLAGS, 0o666)
+    try:
+        if in_file.file_size >= PREALLOCATE_MIN_SIZE:
+            # reserve all extents at once instead of growing the file write by write
+            try:
+                _preallocate(out_fd, in_file.file_size)
+            except OSError as err:
+                if __debug:
+                    print(f'Preallocation failed: {err}')
+        if in_file.compress_type == ZIP_STORED:
+            _write_stored_entry(mm, fd, offset, out_fd, in_file, read_block, crc32, __debug)
+        elif in_file.file_size <= SMALL_ENTRY_LIMIT:
+            _write_compressed_entry_oneshot(mm, offset, out_fd, in_file, factory, crc32, error_types, __debug)
+        else:
+            _write_compressed_entry(
+                mm, offset, out_fd, in_file, read_block, factory, crc32, error_types, __debug)
+    except BaseException:
+        os.close(out_fd)
+        # a preallocated output already has its announced size, zeros where nothing was written
+        try:
+            os.unlink(unpack_str)
+        except OSError:
+            pass
+        raise
+    os.close(out_fd)
+
+
+def _entry_ranges(entries):
+    """Byte ranges of the entries in the archive, adjacent entries are merged. Entries that are
+    not extracted (filtered, directories, duplicates) may lie in between, they are left out"""
+    ranges = []
+    for in_file in entries:
+        start = in_file.header_offset
+        # only used for hints: the local extra field may be longer, a data descriptor may follow
+        end = start + LOCAL_FILE_HEADER_SIZE + len(in_file.filename) + len(in_file.extra) + in_file.compress_size
+        if ranges and 0 <= start - ranges[-1][1] <= mmap.PAGESIZE:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def _build_extractor(mm, fd, extra_str, read_block, factory, crc32, error_types, __debug=None):
+    """Binds everything fixed for one extraction, worker jobs only get their batch of entries"""
+    join = os.path.join
+    extract_entry = _extract_entry_sync
+
+    def extract_batch(entries):
+        ranges = _entry_ranges(entries)
+        for start, end in ranges:
+            _advise(mm, MADV_WILLNEED, start, min(end - start, WILLNEED_LIMIT))
+        for in_file in entries:
+            extract_entry(
+                mm, fd, in_file, join(extra_str, in_file.filename), read_block,
+                factory, crc32, error_types, __debug)
+        # unmaps the pages of the batch from the process, the file stays in the page cache.
+        # Another worker touching a shared edge page only faults it back in
+        for start, end in ranges:
+            _advise(mm, MADV_DONTNEED, start, end - start)
+
+    return extract_batch
+
+
+def _read_central_directory(zip_file):
+    """Opens the archive, returns it with all its entries in central directory order. ZipFile raises
+    BadZipFile by itself, an is_zipfile() pre-check would only scan for the end of central directory twice"""
+    archive = ZipFile(zip_file)
+    return archive, archive.infolist()[:]
+
+
+def _select_entries(entries, whitelist, regex_search):
+    if whitelist is None and regex_search is None:
+        return entries
+    return [in_file for in_file in entries if _should_extract(in_file.filename, whitelist, regex_search)]
+
+
+def _check_supported(in_file):
+    # raised before any output is written, with the errors of ZipFile.open()
+    if in_file.flag_bits & 0x1:
+        raise RuntimeError(f"File {in_file.filename!r} is encrypted, password required for extraction")
+    if in_file.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+        raise NotImplementedError("That compression method is not supported")
+
+
+def _file_entries(entries, extra_str):
+    """Returns the file entries to write, one per output path, in on-disk order"""
+    outputs = {}
+    for in_file in entries:
+        if in_file.is_dir():
+            continue
+        _check_supported(in_file)
+        # different names may still be one file ("d//x" and "d/x", "A" and "a" on a case-insensitive
+        # filesystem), different workers would write it at once. The last entry in central directory
+        # order wins, as in a sequential extraction
+        outputs[os.path.normcase(os.path.normpath(os.path.join(extra_str, in_file.filename)))] = in_file
+    # central directory order is not necessarily the on-disk order, reading in
+    # header_offset order keeps the access pattern sequential for readahead
+    return sorted(outputs.values(), key=attrgetter('header_offset'))
+
+
+def _make_dirs(entries, extra_str):
+    """Creates every directory needed by the entries once, parents first, before any worker starts"""
+    if extra_str:
+        os.makedirs(extra_str, exist_ok=True)
+    dirs = set()
+    for in_file in entries:
+        # dirname() of a directory entry ("dir/") is the directory itself
+        dir_name = os.path.dirname(in_file.filename)
+        # ancestors are added as well, a known one means all of its ancestors are known too
+        while dir_name and dir_name not in dirs:
+            dirs.add(dir_name)
+            parent = os.path.dirname(dir_name)
+            if parent == dir_name:
+                break
+            dir_name = parent
+    # a parent is always shorter than its children, so plain mkdir() is enough
+    for dir_name in sorted(dirs, key=len):
+        try:
+            os.mkdir(os.path.join(extra_str, dir_name))
+        except FileExistsError:
+            pass
+
+
+def _batch_entries(entries):
+    """Groups consecutive small entries, bigger ones get a batch of their own"""
+    batch = []
+    for in_file in entries:
+        if in_file.file_size >= SMALL_ENTRY_BATCH_LIMIT:
+            # the batch ends here, small entries after the big one are not consecutive with it
+            if batch:
+                yield batch
+                batch = []
+            yield [in_file]
+            continue
+        batch.append(in_file)
+        if len(batch) == SMALL_ENTRY_BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class UnzipContext:
+    """Parses the central directory and maps the archive once, for any number of extract() calls
+    (e.g. different subsets of the same archive):
+
+        async with UnzipContext('archive.zip') as archive:
+            await archive.extract('json_dir', regex_files=r'\\.json$')
+            await archive.extract('docs_dir', files=['docs/readme.txt'])
+    """
+
+    def __init__(self, zip_file, buffer_size=None, backend=None, max_workers=None, debug=None):
+        self.zip_file = zip_file
+        self.worker_count = max_workers if (max_workers and int(max_workers)>0) else DEFAULT_MAX_WORKERS
+        self.backend = backend or _default_backend()
+        self._factory, self._crc32, self._error_types = _resolve_backend(self.backend)
+        self._buffer_size = buffer_size
+        self._debug = debug
+        self._pool = None
+        self._archive = None
+        self._mm = None
+        self._entries = None
+
+    async def open(self):
+        loop = asyncio.get_event_loop()
+        if self._debug and uvloop is not None and not isinstance(loop, uvloop.Loop):
+            print("uvloop is installed but not used, see run() and install_uvloop()")
+        self._pool = ThreadPoolExecutor(max_workers=self.worker_count)
+        try:
+            # parsing the central directory of an archive with many entries takes a while,
+            # it is done by a worker not to hold the event loop
+            self._archive, self._entries = await loop.run_in_executor(
+                self._pool, _read_central_directory, self.zip_file)
+            # the archive is mapped once for all workers, entry data is read by slicing
+            # the map without syscalls or copies
+            self._fd = self._archive.fp.fileno()
+            self._read_block = _select_buffer_size(self._buffer_size, self._fd, self.backend)
+            self._mm = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            await self.aclose()
+            raise
+        if self.worker_count == 1:
+            # entries are read strictly in header_offset order
+            _advise(self._mm, MADV_SEQUENTIAL, 0, len(self._mm))
+        return self
+
+    def close(self):
+        # workers still reading the map after a failure finish first
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+        if self._mm is not None:
+            self._mm.close()
+        if self._archive is not None:
+            self._archive.close()
+
+    async def aclose(self):
+        # waiting for busy workers would hold the event loop, the default executor does it.
+        # The close also completes when this await is cancelled
+        await asyncio.get_event_loop().run_in_executor(None, self.close)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def extract(self, path=None, files=[], regex_files=None, verify=True):
+        whitelist = frozenset(files) if files else None
+        regex_search = _compile_patterns(regex_files)
+        # plain strings, os.path.join() is much cheaper than building PurePath objects per entry
+        extra_str = '' if path is None else os.fspath(path)
+        crc32 = self._crc32 if verify else None
+        loop = asyncio.get_event_loop()
+        selected_entries = await loop.run_in_executor(
+            self._pool, _select_entries, self._entries, whitelist, regex_search)
+        await loop.run_in_executor(self._pool, _make_dirs, selected_entries, extra_str)
+        file_entries = await loop.run_in_executor(self._pool, _file_entries, selected_entries, extra_str)
+        # decompression runs off the event loop, one batch of entries per worker job. All of them
+        # are awaited even after a failure, no job of this call outlives it
+        extract_batch = _build_extractor(
+            self._mm, self._fd, extra_str, self._read_block,
+            self._factory, crc32, self._error_types, self._debug)
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self._pool, extract_batch, batch)
+            for batch in _batch_entries(file_entries)), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+
+async def unzip(zip_file, path=None, files=[], regex_files=None, buffer_size=None, __debug=None, *,
+                backend=None, max_workers=None, verify=True):
+    async with UnzipContext(zip_file, buffer_size, backend, max_workers, debug=__debug) as archive:
+        await archive.extract(path, files, regex_files, verify)
+
+
+def run(coro):
+    """Runs the coroutine (e.g. unzip(...)) on uvloop when it is installed, falls back to asyncio.run"""
+    if uvloop is None:
+        return asyncio.run(coro)
+    if hasattr(uvloop, 'run'):
+        return uvloop.run(coro)
+    loop = uvloop.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def install_uvloop():
+    """Opt-in: makes uvloop the event loop policy of the process, so asyncio.run() uses it as well.
+    Returns False when uvloop is not installed"""
+    if uvloop is None:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
@@ -23,28 +23,6 @@ def find_version(fname):
 
 __version__ = find_version("async_unzip/__init__.py")
 
-missed_modules = 0
-
-try:
-    from aiofile import async_open
-except ModuleNotFoundError as err:
-    missed_modules += 1
-
-try:
-    from aiofiles import open as async_open
-except ModuleNotFoundError as err:
-    missed_modules += 1
-except ImportError as err:
-    missed_modules += 1
-
-if missed_modules == 2:
-    print("""Not aiofile nor aiofiles is present! Going to crash..
-        please do:
-            pip install aiofile
-        or
-            pip install aiofiles
-        to make the code working, Thanks!""")
-
 setup(
     name="async-unzip",
     version=__version__,
@@ -56,6 +34,12 @@ setup(
     url="https://github.com/ueni-ltd/async-unzip",
     packages=["async_unzip"],
     install_requires=REQUIRES,
+    extras_require={
+        "isal": ["isal"],
+        "zlib-ng": ["zlib-ng"],
+        "libdeflate": ["deflate"],
+        "uvloop": ["uvloop; platform_system != 'Windows'"],
+    },
     license="MIT",
     zip_safe=False,
     keywords="async unzip",
@@ -0,0 +1,353 @@
+import asyncio
+import os
+import pathlib
+import struct
+import threading
+import types
+import zipfile
+
+import pytest
+
+from async_unzip import unzipper
+from async_unzip.unzipper import UnzipContext, unzip
+
+BACKENDS = sorted(unzipper._AVAILABLE_BACKENDS)
+
+
+def _write_zip(path, entries, compression=zipfile.ZIP_DEFLATED):
+    """entries: (name, data) pairs, written in order, directories end with a slash"""
+    with zipfile.ZipFile(path, 'w', compression) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+    return path
+
+
+def _patch_central_directory(path, field_offset, fmt, *values):
+    """Overwrites a field of the first central directory header"""
+    data = bytearray(path.read_bytes())
+    header = data.find(b'PK\x01\x02')
+    struct.pack_into(fmt, data, header + field_offset, *values)
+    path.write_bytes(bytes(data))
+
+
+def _extracted(root):
+    root = pathlib.Path(root)
+    return {path.relative_to(root).as_posix(): path.read_bytes() for path in root.rglob('*') if path.is_file()}
+
+
+def _expected(path):
+    with zipfile.ZipFile(path) as archive:
+        return {info.filename: archive.read(info) for info in archive.infolist() if not info.is_dir()}
+
+
+def _payload(size, seed):
+    # compressible, but not trivially: the streaming path gets several blocks per entry
+    line = bytes(range(seed % 7, 256, 3))
+    return (line * (size // len(line) + 1))[:size]
+
+
+@pytest.fixture
+def mixed_zip(tmp_path):
+    path = tmp_path / 'mixed.zip'
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('empty.txt', b'')
+        archive.writestr('dir/', b'')
+        archive.writestr(zipfile.ZipInfo('stored.bin'), os.urandom(300 * 1024))
+        archive.writestr('a/b/c.txt', b'hello world\n' * 100, zipfile.ZIP_DEFLATED)
+        archive.writestr('big.txt', _payload(3 * 1024 * 1024, 1), zipfile.ZIP_DEFLATED)
+        for i in range(100):
+            archive.writestr(f'small/{i % 5}/{i}.json', _payload(100 + i * 37, i), zipfile.ZIP_DEFLATED)
+    return path
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('libdeflate', [True, False])
+def test_extracts_like_zipfile(tmp_path, mixed_zip, backend, libdeflate, monkeypatch):
+    if not libdeflate:
+        monkeypatch.setattr(unzipper, 'deflate', None)
+    out = tmp_path / 'out'
+    asyncio.run(unzip(mixed_zip, path=out, backend=backend))
+    assert _extracted(out) == _expected(mixed_zip)
+    assert (out / 'dir').is_dir()
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_streamed_entries_extract_like_zipfile(tmp_path, mixed_zip, backend, monkeypatch):
+    # every compressed entry goes through the streaming path, in small blocks
+    monkeypatch.setattr(unzipper, 'SMALL_ENTRY_LIMIT', 0)
+    out = tmp_path / 'out'
+    asyncio.run(unzip(mixed_zip, path=out, backend=backend, buffer_size=4096))
+    assert _extracted(out) == _expected(mixed_zip)
+
+
+def test_streams_highly_compressed_entry(tmp_path, monkeypatch):
+    # one input block inflates to many capped decompress() calls
+    monkeypatch.setattr(unzipper, 'SMALL_ENTRY_LIMIT', 0)
+    path = _write_zip(tmp_path / 'zeros.zip', [('zeros.bin', bytes(8 * 1024 * 1024))])
+    out = tmp_path / 'out'
+    asyncio.run(unzip(path, path=out))
+    assert _extracted(out) == _expected(path)
+
+
+@pytest.mark.parametrize('max_workers', [1, 4])
+def test_stored_entries_without_kernel_copy(tmp_path, mixed_zip, max_workers, monkeypatch):
+    monkeypatch.setattr(unzipper, '_KERNEL_COPIES', [])
+    out = tmp_path / 'out'
+    asyncio.run(unzip(mixed_zip, path=out, max_workers=max_workers))
+    assert _extracted(out) == _expected(mixed_zip)
+
+
+def test_extracts_into_current_directory(tmp_path, mixed_zip, monkeypatch):
+    out = tmp_path / 'out'
+    out.mkdir()
+    monkeypatch.chdir(out)
+    asyncio.run(unzip(mixed_zip))
+    assert _extracted(out) == _expected(mixed_zip)
+
+
+def test_duplicate_names_keep_last_entry(tmp_path):
+    first, last = os.urandom(3 * 1024 * 1024), os.urandom(3 * 1024 * 1024)
+    path = tmp_path / 'duplicates.zip'
+    with pytest.warns(UserWarning):
+        _write_zip(path, [('same.bin', first), ('same.bin', last)], zipfile.ZIP_STORED)
+    out = tmp_path / 'out'
+    asyncio.run(unzip(path, path=out, max_workers=4))
+    assert _extracted(out) == {'same.bin': last}
+
+
+def test_names_of_one_path_keep_last_entry(tmp_path):
+    first, last = os.urandom(3 * 1024 * 1024), os.urandom(2 * 1024 * 1024)
+    path = _write_zip(tmp_path / 'paths.zip', [('d/x.bin', first), ('d//x.bin', last)], zipfile.ZIP_STORED)
+    out = tmp_path / 'out'
+    asyncio.run(unzip(path, path=out, max_workers=4))
+    assert _extracted(out) == {'d/x.bin': last}
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+@pytest.mark.parametrize('size', [1000, 300 * 1024, 6 * 1024 * 1024])
+def test_bad_crc_raises(tmp_path, compression, size):
+    path = _write_zip(tmp_path / 'crc.zip', [('data.bin', _payload(size, 3))], compression)
+    with zipfile.ZipFile(path) as archive:
+        crc = archive.getinfo('data.bin').CRC
+    _patch_central_directory(path, 16, '<I', crc ^ 1)
+    with pytest.raises(zipfile.BadZipFile, match='Bad CRC-32'):
+        asyncio.run(unzip(path, path=tmp_path / 'out'))
+    assert _extracted(tmp_path / 'out') == {}
+    asyncio.run(unzip(path, path=tmp_path / 'unverified', verify=False))
+    assert _extracted(tmp_path / 'unverified') == {'data.bin': _payload(size, 3)}
+
+
+def test_corrupt_stored_data_raises(tmp_path):
+    path = _write_zip(tmp_path / 'stored.zip', [('data.bin', _payload(100000, 4))], zipfile.ZIP_STORED)
+    data = bytearray(path.read_bytes())
+    data[30 + len('data.bin') + 5000] ^= 0xff
+    path.write_bytes(bytes(data))
+    with pytest.raises(zipfile.BadZipFile, match='Bad CRC-32'):
+        asyncio.run(unzip(path, path=tmp_path / 'out'))
+    assert _extracted(tmp_path / 'out') == {}
+
+
+@pytest.mark.parametrize('declared', [1000, 8 * 1024 * 1024, 20 * 1024 * 1024])
+@pytest.mark.parametrize('libdeflate', [True, False])
+def test_wrong_uncompressed_size_raises(tmp_path, declared, libdeflate, monkeypatch):
+    if not libdeflate:
+        monkeypatch.setattr(unzipper, 'deflate', None)
+    path = _write_zip(tmp_path / 'size.zip', [('zeros.bin', bytes(10 * 1024 * 1024))])
+    _patch_central_directory(path, 24, '<I', declared)
+    with pytest.raises(zipfile.BadZipFile, match='Bad uncompressed size'):
+        asyncio.run(unzip(path, path=tmp_path / 'out', verify=False))
+
+
+@pytest.mark.parametrize('declared', [1000, 8 * 1024 * 1024])
+def test_missing_compressed_data_raises(tmp_path, declared):
+    path = _write_zip(tmp_path / 'missing.zip', [('data.bin', b'')])
+    _patch_central_directory(path, 20, '<II', 0, declared)
+    with pytest.raises(zipfile.BadZipFile):
+        asyncio.run(unzip(path, path=tmp_path / 'out'))
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA])
+def test_unsupported_compression_raises(tmp_path, compression):
+    path = _write_zip(tmp_path / 'method.zip', [('data.bin', _payload(1000, 5))], compression)
+    with pytest.raises(NotImplementedError, match='compression method is not supported'):
+        asyncio.run(unzip(path, path=tmp_path / 'out'))
+    assert _extracted(tmp_path / 'out') == {}
+
+
+def test_encrypted_entry_raises(tmp_path):
+    path = _write_zip(tmp_path / 'encrypted.zip', [('data.bin', _payload(1000, 6))])
+    _patch_central_directory(path, 8, '<H', 0x1)
+    with pytest.raises(RuntimeError, match="'data.bin' is encrypted"):
+        asyncio.run(unzip(path, path=tmp_path / 'out'))
+
+def test_bad_local_header_raises(tmp_path):
+    path = _write_zip(tmp_path / 'header.zip', [('data.bin', b'data' * 100)])
+    data = bytearray(path.read_bytes())
+    data[2] = 0
+    path.write_bytes(bytes(data))
+    with pytest.raises(zipfile.BadZipFile, match='Bad local file header'):
+        asyncio.run(unzip(path, path=tmp_path / 'out'))
+
+
+def test_not_a_zip_raises(tmp_path):
+    path = tmp_path / 'plain.zip'
+    path.write_bytes(b'not a zip file' * 10)
+    with pytest.raises(zipfile.BadZipFile):
+        asyncio.run(unzip(path, path=tmp_path / 'out'))
+
+
+def test_unknown_backend_raises(mixed_zip):
+    with pytest.raises(ValueError, match='not available'):
+        asyncio.run(unzip(mixed_zip, backend='nope'))
+
+
+@pytest.mark.parametrize('kwargs, names', [
+    ({'files': ['a/b/c.txt', 'stored.bin', 'missing']}, {'a/b/c.txt', 'stored.bin'}),
+    ({'regex_files': r'^small/3/'}, {f'small/3/{i}.json' for i in range(3, 100, 5)}),
+    ({'regex_files': [r'\.bin$', r'^a/']}, {'stored.bin', 'a/b/c.txt'}),
+    ({'regex_files': r'(?i)\.TXT$'}, {'empty.txt', 'a/b/c.txt', 'big.txt'}),
+    ({'regex_files': [r'(?i)^BIG', r'^a/']}, {'big.txt', 'a/b/c.txt'}),
+    ({'regex_files': [r'^(?P<top>a)/', r'^(?P<top>b)ig']}, {'a/b/c.txt', 'big.txt'}),
+    ({'regex_files': [r'\.txt$'], 'files': ['big.txt', 'stored.bin']}, {'big.txt'}),
+])
+def test_filters(tmp_path, mixed_zip, kwargs, names):
+    out = tmp_path / 'out'
+    asyncio.run(unzip(mixed_zip, path=out, **kwargs))
+    expected = _expected(mixed_zip)
+    assert _extracted(out) == {name: expected[name] for name in names}
+
+
+def test_filtered_entries_are_not_decompressed(tmp_path, mixed_zip, monkeypatch):
+    def fail(*args):
+        raise AssertionError('a filtered entry was decompressed')
+
+    monkeypatch.setattr(unzipper, '_write_compressed_entry', fail)
+    monkeypatch.setattr(unzipper, '_write_compressed_entry_oneshot', fail)
+    out = tmp_path / 'out'
+    asyncio.run(unzip(mixed_zip, path=out, files=['stored.bin']))
+    assert _extracted(out) == {'stored.bin': _expected(mixed_zip)['stored.bin']}
+
+def test_backreferences_keep_their_groups(tmp_path):
+    # in a single alternation \1 of the second pattern would refer to the group of the first one
+    path = _write_zip(tmp_path / 'names.zip', [(name, name.encode()) for name in ('big.txt', 'xx.txt', 'xy.txt')])
+    out = tmp_path / 'out'
+    asyncio.run(unzip(path, path=out, regex_files=[r'^(b)ig', r'^(\w)\1']))
+    assert sorted(_extracted(out)) == ['big.txt', 'xx.txt']
+
+
+def test_context_extracts_several_times(tmp_path, mixed_zip):
+    async def extract():
+        async with UnzipContext(mixed_zip) as archive:
+            await archive.extract(tmp_path / 'json', regex_files=r'\.json$')
+            await archive.extract(tmp_path / 'one', files=['big.txt'])
+
+    asyncio.run(extract())
+    expected = _expected(mixed_zip)
+    assert _extracted(tmp_path / 'json') == {
+        name: data for name, data in expected.items() if name.endswith('.json')}
+    assert _extracted(tmp_path / 'one') == {'big.txt': expected['big.txt']}
+
+
+def test_context_closes_off_the_event_loop(mixed_zip):
+    async def close_while_busy():
+        release = threading.Event()
+        archive = await UnzipContext(mixed_zip).open()
+        archive._pool.submit(release.wait, 1)
+        closing = asyncio.ensure_future(archive.__aexit__(None, None, None))
+        await asyncio.sleep(0.05)
+        # the loop kept running while the close waited for the busy worker
+        assert not closing.done()
+        release.set()
+        await closing
+        assert archive._mm.closed
+
+    asyncio.run(close_while_busy())
+
+def test_debug_keeps_its_position(tmp_path, capsys):
+    data = _payload(6 * 1024 * 1024, 7)
+    path = _write_zip(tmp_path / 'debug.zip', [('data.bin', data)])
+    asyncio.run(unzip(path, tmp_path / 'out', [], None, None, True))
+    assert _extracted(tmp_path / 'out') == {'data.bin': data}
+    assert 'Length: ' in capsys.readouterr().out
+
+def test_run(tmp_path, mixed_zip):
+    unzipper.run(unzip(mixed_zip, path=tmp_path / 'out'))
+    assert _extracted(tmp_path / 'out') == _expected(mixed_zip)
+
+
+class _StubPolicy(asyncio.DefaultEventLoopPolicy):
+    pass
+
+
+def test_install_uvloop(monkeypatch):
+    monkeypatch.setattr(unzipper, 'uvloop', None)
+    policy = asyncio.get_event_loop_policy()
+    assert unzipper.install_uvloop() is False
+    assert asyncio.get_event_loop_policy() is policy
+
+    monkeypatch.setattr(unzipper, 'uvloop', types.SimpleNamespace(EventLoopPolicy=_StubPolicy))
+    try:
+        assert unzipper.install_uvloop() is True
+        assert isinstance(asyncio.get_event_loop_policy(), _StubPolicy)
+    finally:
+        asyncio.set_event_loop_policy(None)
+
+
+@pytest.mark.parametrize('uvloop, hint', [
+    (None, False),
+    (types.SimpleNamespace(Loop=type('Loop', (), {})), True),
+    (types.SimpleNamespace(Loop=asyncio.AbstractEventLoop), False),
+])
+def test_uvloop_hint(mixed_zip, monkeypatch, capsys, uvloop, hint):
+    monkeypatch.setattr(unzipper, 'uvloop', uvloop)
+
+    async def open_and_close():
+        async with UnzipContext(mixed_zip, debug=True):
+            pass
+
+    asyncio.run(open_and_close())
+    assert ('uvloop is installed but not used' in capsys.readouterr().out) is hint
+
+def test_write_chunks_resumes_short_writes(tmp_path, monkeypatch):
+    real_write = os.write
+
+    def short_writev(fd, buffers):
+        # at most 7 bytes per call, splitting buffers anywhere
+        return real_write(fd, b''.join(bytes(buf) for buf in buffers)[:7])
+
+    monkeypatch.setattr(os, 'writev', short_writev)
+    chunks = [os.urandom(size) for size in (0, 5, 13, 1, 0, 30, 7)]
+    path = tmp_path / 'chunks'
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        unzipper._write_chunks(fd, chunks)
+    finally:
+        os.close(fd)
+    assert path.read_bytes() == b''.join(chunks)
+
+
+def test_batches_hold_consecutive_small_entries():
+    def entry(name, size):
+        info = zipfile.ZipInfo(name)
+        info.file_size = size
+        return info
+
+    big = unzipper.SMALL_ENTRY_BATCH_LIMIT
+    entries = [entry('s1', 1), entry('s2', 1), entry('big', big), entry('s3', 1), entry('big2', big), entry('s4', 1)]
+    batches = [[info.filename for info in batch] for batch in unzipper._batch_entries(entries)]
+    assert batches == [['s1', 's2'], ['big'], ['s3'], ['big2'], ['s4']]
+
+
+def test_batch_ranges_leave_out_skipped_entries(tmp_path):
+    path = str(tmp_path / 'gap.zip')
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        zip_file.writestr('s1', b'1')
+        zip_file.writestr('s2', b'2')
+        zip_file.writestr('skipped', _payload(256 * 1024, 1))
+        zip_file.writestr('s3', b'3')
+    with zipfile.ZipFile(path) as zip_file:
+        infos = {info.filename: info for info in zip_file.infolist()}
+
+    ranges = unzipper._entry_ranges([infos['s1'], infos['s2'], infos['s3']])
+    assert [start for start, _ in ranges] == [infos['s1'].header_offset, infos['s3'].header_offset]
+    assert ranges[0][1] < infos['skipped'].header_offset + infos['skipped'].compress_size